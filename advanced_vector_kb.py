@@ -1,56 +1,207 @@
 import os
+import sys
 import chromadb
-from chromadb.utils import embedding_functions
+import numpy as np
 import hashlib
 import re
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import logging
 import json
+import functools
+import copy
+import queue
+import atexit
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class AdvancedVectorKnowledgeBase:
-    def __init__(self, db_path: str = "./local_db"):
-        """初始化向量知识库"""
-        self.chroma_client = chromadb.PersistentClient(path=db_path)
-        self.embedding = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="all-MiniLM-L6-v2"
-        )
-        self.collection = self.chroma_client.get_or_create_collection(
-            name="my_knowledge_base",
-            embedding_function=self.embedding
+# 每次写入向量数据库的文档块数量，跨文件累积后批量嵌入
+BATCH_SIZE = 512
+# 并行提取文本的进程数，可通过环境变量 KB_EXTRACT_WORKERS 调整
+EXTRACT_WORKERS = int(os.environ.get("KB_EXTRACT_WORKERS", os.cpu_count() or 1))
+# 嵌入模型及推理后端："sentence-transformers"（默认）或 "onnx-int8"
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_BACKEND = os.environ.get("KB_EMBEDDING_BACKEND", "sentence-transformers")
+# INT8 量化 ONNX 模型的缓存目录，首次使用时导出并量化
+ONNX_MODEL_DIR = os.environ.get("KB_ONNX_MODEL_DIR", "./onnx_model")
+# 嵌入推理线程数（作用于整个进程，包括入库时的批量嵌入）。默认不限制，由 torch / onnxruntime
+# 按核数使用多线程；多线程并发搜索的服务可设为 1，避免各查询的线程池互相争抢核心
+_embedding_threads = os.environ.get("KB_EMBEDDING_THREADS")
+EMBEDDING_THREADS = int(_embedding_threads) if _embedding_threads else None
+# 向量集合配置：嵌入向量已归一化，使用余弦距离（新建集合时生效，已有集合沿用原度量）；
+# HNSW 参数针对十万级向量调整，较大的 M / construction_ef / search_ef 提高召回。
+# 这些参数和距离度量一样只在新建集合时生效，已有集合的索引沿用创建时的参数
+# （不写入 hnsw:num_threads：chromadb 加载索引时默认使用本机核数，写入会把建库机器的核数固化进数据库）
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+    "hnsw:search_ef": 64,
+}
+# 搜索结果 LRU 缓存的最大条目数
+SEARCH_CACHE_SIZE = 256
+# 入库时嵌入模型单次前向计算的文本数量（GPU 上使用更大的批量）
+EMBEDDING_BATCH_SIZE = 64
+GPU_EMBEDDING_BATCH_SIZE = 128
+# OCR 先用英文模型快速识别，平均置信度低于阈值或非 ASCII 字符过多时再用中英文模型重识别
+OCR_ENG_MIN_CONF = 60
+OCR_MAX_NON_ASCII_RATIO = 0.05
+# OCR 前将图片缩放到的最大尺寸，避免超高分辨率图片拖慢识别
+OCR_MAX_IMAGE_SIZE = (2000, 2000)
+# 后台写入队列允许积压的批次数，队列满时 add_documents 会阻塞等待
+WRITE_QUEUE_SIZE = 4
+
+# 一批文档块以三个并列列表表示：(texts, ids, metadatas)
+DocumentBatch = Tuple[List[str], List[str], List[Dict[str, Any]]]
+
+# 文本清理用的预编译正则：合并空白字符；移除中文、英文、数字和基本标点以外的字符
+# （保留中文句末标点，供分块时识别句子边界）
+_WS_RE = re.compile(r'\s+')
+_STRIP_RE = re.compile(r'[^\w\s\u4e00-\u9fff.,!?;:()（）。！？\-_]')
+# ASCII 快速路径：用 str.translate 删除不允许的 ASCII 字符，只有非 ASCII 文本才需要再走正则
+_ASCII_DELETE_TABLE = {i: None for i in range(128) if _STRIP_RE.match(chr(i))}
+# 句子边界：中英文句末标点，句子在标点之后结束
+_SENTENCE_END_RE = re.compile(r'[。！？.!?]')
+
+
+class SentenceTransformerEmbedding:
+    """SentenceTransformer 嵌入函数：有 CUDA 时在 GPU 上以 FP16 推理，否则使用 CPU"""
+    
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, device: Optional[str] = None):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = SentenceTransformer(model_name, device=device)
+        if device.startswith("cuda"):
+            self.model.half()
+            self.batch_size = GPU_EMBEDDING_BATCH_SIZE
+        else:
+            self.batch_size = EMBEDDING_BATCH_SIZE
+        logger.info(f"嵌入模型 {model_name} 运行于: {device}")
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """批量计算归一化嵌入向量，返回连续的 float32 矩阵"""
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
         )
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+    
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        return self.encode(input).tolist()
+
+
+class OnnxEmbeddingFunction:
+    """基于 ONNX Runtime 的 INT8 动态量化嵌入函数，输出与 SentenceTransformer 一致的归一化向量"""
+    
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, model_dir: str = ONNX_MODEL_DIR,
+                 num_threads: Optional[int] = EMBEDDING_THREADS):
+        from onnxruntime import SessionOptions
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
         
+        model_id = f"sentence-transformers/{model_name}"
+        quantized_file = "model_quantized.onnx"
+        if not os.path.exists(os.path.join(model_dir, quantized_file)):
+            logger.info(f"导出并量化嵌入模型到: {model_dir}")
+            model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+            quantizer = ORTQuantizer.from_pretrained(model)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=model_dir, quantization_config=qconfig)
+            AutoTokenizer.from_pretrained(model_id).save_pretrained(model_dir)
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        session_options = SessionOptions()
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+            session_options.inter_op_num_threads = num_threads
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=quantized_file, session_options=session_options
+        )
+    
+    def encode(self, texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE) -> np.ndarray:
+        """按批计算嵌入向量，返回连续的 float32 矩阵"""
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            encoded = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                     max_length=256, return_tensors="np")
+            token_embeddings = self.model(**encoded).last_hidden_state
+            # 与 SentenceTransformer 相同的 mean pooling + L2 归一化
+            mask = np.expand_dims(encoded["attention_mask"], -1).astype(np.float32)
+            embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+            batches.append(embeddings.astype(np.float32))
+        return np.concatenate(batches) if batches else np.empty((0, 0), dtype=np.float32)
+    
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        return self.encode(input).tolist()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_embedding():
+    """返回进程内共享的嵌入函数，按 KB_EMBEDDING_BACKEND 选择后端，ONNX 依赖缺失时回退到 SentenceTransformer"""
+    if EMBEDDING_THREADS is not None:
+        # 必须在加载 torch / onnxruntime 之前设置，否则 OpenMP 线程池已按核数创建
+        os.environ["OMP_NUM_THREADS"] = str(EMBEDDING_THREADS)
+        try:
+            import torch
+            torch.set_num_threads(EMBEDDING_THREADS)
+        except ImportError:
+            pass
+    
+    if EMBEDDING_BACKEND == "onnx-int8":
+        try:
+            return OnnxEmbeddingFunction()
+        except ImportError:
+            logger.warning("optimum[onnxruntime]未安装，使用SentenceTransformer嵌入模型")
+    return SentenceTransformerEmbedding()
+
+
+class DocumentProcessor:
+    """文档解析器：负责文本提取、清理和分块，不持有数据库连接，可在子进程中使用"""
+    
     def extract_text_from_txt(self, file_path: str) -> str:
-        """从文本文件中提取文本"""
+        """从文本文件中提取文本（只读取一次文件，UTF-8 解码失败时按 GBK 解码同一份数据）"""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        except UnicodeDecodeError:
-            try:
-                with open(file_path, 'r', encoding='gbk') as f:
-                    return f.read()
-            except Exception as e:
-                logger.error(f"处理文本文件 {file_path} 时出错: {e}")
-                return ""
+            with open(file_path, 'rb') as f:
+                raw = f.read()
         except Exception as e:
             logger.error(f"处理文本文件 {file_path} 时出错: {e}")
             return ""
+        
+        try:
+            return raw.decode('utf-8')
+        except UnicodeDecodeError:
+            return raw.decode('gbk', errors='replace')
     
     def extract_text_from_pdf_simple(self, file_path: str) -> str:
-        """从PDF文件中提取文本（简化版本，使用系统命令）"""
+        """从PDF文件中提取文本（简化版本，使用pypdfium2在进程内解析）"""
         try:
-            # 尝试使用系统命令提取PDF文本
-            import subprocess
-            result = subprocess.run(['pdftotext', file_path, '-'], 
-                                  capture_output=True, text=True, timeout=30)
-            if result.returncode == 0:
-                return result.stdout
-            else:
-                logger.warning(f"PDF文本提取失败，尝试其他方法: {file_path}")
-                return self.extract_text_from_pdf_fallback(file_path)
+            import pypdfium2
+            pdf = pypdfium2.PdfDocument(file_path)
+            try:
+                pages = []
+                for page in pdf:
+                    textpage = page.get_textpage()
+                    pages.append(textpage.get_text_range())
+                    textpage.close()
+                    page.close()
+                return "\n".join(pages)
+            finally:
+                pdf.close()
+        except ImportError:
+            logger.warning("pypdfium2未安装，使用备用方法处理PDF文件")
+            return self.extract_text_from_pdf_fallback(file_path)
         except Exception as e:
             logger.warning(f"PDF处理失败，使用备用方法: {e}")
             return self.extract_text_from_pdf_fallback(file_path)
@@ -68,7 +219,7 @@ class AdvancedVectorKnowledgeBase:
             return text
         except ImportError:
             logger.warning("PyPDF2未安装，无法处理PDF文件")
-            return f"[PDF文件: {os.path.basename(file_path)} - 需要安装PyPDF2或pdftotext工具]"
+            return f"[PDF文件: {os.path.basename(file_path)} - 需要安装pypdfium2或PyPDF2]"
         except Exception as e:
             logger.error(f"PDF备用方法也失败: {e}")
             return f"[PDF文件: {os.path.basename(file_path)} - 处理失败]"
@@ -97,7 +248,10 @@ class AdvancedVectorKnowledgeBase:
             import pytesseract
             from PIL import Image
             image = Image.open(file_path)
-            text = pytesseract.image_to_string(image, lang='chi_sim+eng')
+            image.thumbnail(OCR_MAX_IMAGE_SIZE)
+            text = self._ocr_english(image)
+            if text is None:
+                text = pytesseract.image_to_string(image, lang='chi_sim+eng')
             return text if text.strip() else f"[图片文件: {os.path.basename(file_path)} - 未检测到文本]"
         except ImportError:
             logger.warning("pytesseract或PIL未安装，无法处理图片文件")
@@ -106,10 +260,34 @@ class AdvancedVectorKnowledgeBase:
             logger.error(f"处理图片文件 {file_path} 时出错: {e}")
             return f"[图片文件: {os.path.basename(file_path)} - 处理失败]"
     
-    def extract_metadata_from_file(self, file_path: str) -> Dict[str, Any]:
-        """提取文件元数据"""
+    def _ocr_english(self, image) -> Optional[str]:
+        """仅用英文模型快速识别；结果可信时返回文本，否则返回 None 表示需要中英文模型"""
+        import pytesseract
+        data = pytesseract.image_to_data(image, lang='eng', config='--psm 6',
+                                         output_type=pytesseract.Output.DICT)
+        lines: Dict[tuple, List[str]] = {}
+        confs = []
+        for i, word in enumerate(data['text']):
+            conf = float(data['conf'][i])
+            if conf < 0 or not word.strip():
+                continue
+            confs.append(conf)
+            key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+            lines.setdefault(key, []).append(word)
+        if not confs or sum(confs) / len(confs) <= OCR_ENG_MIN_CONF:
+            return None
+        
+        text = "\n".join(" ".join(words) for words in lines.values())
+        non_ascii = sum(1 for ch in text if not ch.isascii())
+        if non_ascii / len(text) >= OCR_MAX_NON_ASCII_RATIO:
+            return None
+        return text
+    
+    def extract_metadata_from_file(self, file_path: str, stat: Optional[os.stat_result] = None) -> Dict[str, Any]:
+        """提取文件元数据（可传入已有的 stat 结果，避免重复系统调用）"""
         try:
-            stat = os.stat(file_path)
+            if stat is None:
+                stat = os.stat(file_path)
             return {
                 'file_size': stat.st_size,
                 'created_time': stat.st_ctime,
@@ -126,34 +304,79 @@ class AdvancedVectorKnowledgeBase:
             return ""
         
         # 移除多余的空白字符
-        text = re.sub(r'\s+', ' ', text)
+        text = _WS_RE.sub(' ', text)
         # 移除特殊字符，保留中文、英文、数字和基本标点
-        text = re.sub(r'[^\w\s\u4e00-\u9fff.,!?;:()（）\-_]', '', text)
+        text = text.translate(_ASCII_DELETE_TABLE)
+        if not text.isascii():
+            text = _STRIP_RE.sub('', text)
         return text.strip()
     
-    def split_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
-        """将长文本分割成小块"""
+    def _iter_sentences(self, text: str) -> Iterator[str]:
+        """逐句生成文本（句末标点归入前一句），不预先构建整篇文本的句子列表"""
+        start = 0
+        for match in _SENTENCE_END_RE.finditer(text):
+            yield text[start:match.end()]
+            start = match.end()
+        if start < len(text):
+            yield text[start:]
+    
+    def split_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> Iterator[str]:
+        """按句子边界将长文本分割成小块（逐块生成），相邻块之间重叠末尾若干句"""
         if len(text) <= chunk_size:
-            return [text]
+            yield text
+            return
         
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            chunk = text[start:end]
-            chunks.append(chunk)
-            start = end - overlap
+        current = []
+        current_len = 0
+        for sentence in self._iter_sentences(text):
+            # 超长句子退化为固定窗口切分
+            if len(sentence) > chunk_size:
+                step = chunk_size - overlap
+                pieces = (sentence[i:i + chunk_size] for i in range(0, len(sentence), step))
+            else:
+                pieces = (sentence,)
             
-        return chunks
+            for piece in pieces:
+                if current and current_len + len(piece) > chunk_size:
+                    yield ''.join(current).strip()
+                    # 保留不超过 overlap 长度的末尾句子作为下一块的开头
+                    tail = []
+                    tail_len = 0
+                    for prev in reversed(current):
+                        if tail_len + len(prev) > overlap:
+                            break
+                        tail.insert(0, prev)
+                        tail_len += len(prev)
+                    while tail and tail_len + len(piece) > chunk_size:
+                        tail_len -= len(tail.pop(0))
+                    current, current_len = tail, tail_len
+                current.append(piece)
+                current_len += len(piece)
+        
+        if current:
+            yield ''.join(current).strip()
     
-    def generate_file_id(self, file_path: str) -> str:
-        """生成文件ID"""
-        return hashlib.md5(file_path.encode()).hexdigest()
+    def generate_file_id(self, file_path: str, stat: Optional[os.stat_result] = None) -> str:
+        """生成文件ID（由路径、修改时间和大小决定，文件内容变化后ID随之改变）"""
+        h = hashlib.blake2b(file_path.encode(), digest_size=16)
+        try:
+            if stat is None:
+                stat = os.stat(file_path)
+            h.update(str(stat.st_mtime_ns).encode())
+            h.update(str(stat.st_size).encode())
+        except OSError:
+            pass
+        return h.hexdigest()
     
-    def process_file(self, file_path: str) -> List[Dict[str, Any]]:
-        """处理单个文件并返回文档块"""
+    def process_file(self, file_path: str, stat: Optional[os.stat_result] = None) -> DocumentBatch:
+        """处理单个文件并返回文档块 (texts, ids, metadatas)"""
         file_ext = os.path.splitext(file_path)[1].lower()
-        file_id = self.generate_file_id(file_path)
+        if stat is None:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                pass
+        file_id = self.generate_file_id(file_path, stat)
         
         # 根据文件类型提取文本
         if file_ext == '.txt':
@@ -166,83 +389,308 @@ class AdvancedVectorKnowledgeBase:
             text = self.extract_text_from_image_simple(file_path)
         else:
             logger.warning(f"不支持的文件类型: {file_ext}")
-            return []
+            return [], [], []
         
         if not text:
             logger.warning(f"无法从文件 {file_path} 提取文本")
-            return []
+            return [], [], []
         
         # 清理文本
         text = self.clean_text(text)
         
-        # 分割文本
-        chunks = self.split_text(text)
-        
-        # 提取文件元数据
-        file_metadata = self.extract_metadata_from_file(file_path)
+        # 文件级元数据每个文件只构建一次，字符串经 intern 后被所有文档块共享引用
+        file_metadata = {
+            'file_id': file_id,
+            'file_path': sys.intern(file_path),
+            'file_name': sys.intern(os.path.basename(file_path)),
+            'file_type': sys.intern(file_ext),
+            **self.extract_metadata_from_file(file_path, stat)
+        }
+        # file_extension 与 file_type 完全相同，不再在每个文档块中重复存储
+        file_metadata.pop('file_extension', None)
         
-        # 创建文档块
-        documents = []
-        for i, chunk in enumerate(chunks):
+        # split_text 逐块生成；这里仍需收集整个文件的文档块：total_chunks 要在分块结束后才知道，
+        # 并且结果要整体序列化返回给主进程
+        texts = []
+        ids = []
+        metadatas = []
+        total_chunks = 0
+        for i, chunk in enumerate(self.split_text(text)):
+            total_chunks += 1
             if chunk.strip():  # 只添加非空块
-                documents.append({
-                    'id': f"{file_id}_chunk_{i}",
-                    'text': chunk,
-                    'metadata': {
-                        'file_path': file_path,
-                        'file_name': os.path.basename(file_path),
-                        'file_type': file_ext,
-                        'chunk_index': i,
-                        'total_chunks': len(chunks),
-                        **file_metadata
-                    }
-                })
+                texts.append(chunk)
+                ids.append(f"{file_id}_chunk_{i}")
+                metadatas.append({**file_metadata, 'chunk_index': i})
+        
+        # 分块数量只有在生成结束后才知道，最后统一补上
+        for metadata in metadatas:
+            metadata['total_chunks'] = total_chunks
         
-        return documents
+        return texts, ids, metadatas
+
+
+def _process_file_worker(file_path: str, stat: os.stat_result) -> DocumentBatch:
+    """子进程入口：解析单个文件并返回文档块"""
+    return DocumentProcessor().process_file(file_path, stat)
+
+
+def _iter_files(directory_path: str) -> Iterator[os.DirEntry]:
+    """递归遍历目录中的文件（与 os.walk 相同，不进入符号链接目录），DirEntry 自带缓存的文件类型信息"""
+    try:
+        with os.scandir(directory_path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    if not entry.is_symlink():
+                        yield from _iter_files(entry.path)
+                else:
+                    yield entry
+    except OSError as e:
+        logger.warning(f"无法读取目录 {directory_path}: {e}")
+
+
+class AdvancedVectorKnowledgeBase(DocumentProcessor):
+    def __init__(self, db_path: str = "./local_db"):
+        """初始化向量知识库"""
+        self.chroma_client = chromadb.PersistentClient(path=db_path)
+        self.embedding = _get_embedding()
+        # 只在新建集合时写入配置：get_or_create_collection 会覆盖已有集合的元数据，
+        # 而索引仍沿用创建时的距离度量，两者会不一致
+        try:
+            self.collection = self.chroma_client.get_collection(
+                name="my_knowledge_base",
+                embedding_function=self.embedding
+            )
+        except ValueError:
+            self.collection = self.chroma_client.create_collection(
+                name="my_knowledge_base",
+                embedding_function=self.embedding,
+                metadata=COLLECTION_METADATA
+            )
+        # 距离度量在集合创建后不可更改，在任何元数据修改之前记录下来用于换算相似度
+        self._distance_space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+        # (query, n_results) -> 格式化后的搜索结果，写入数据库时清空
+        self._search_cache: "OrderedDict[tuple, List[Dict[str, Any]]]" = OrderedDict()
+        # 缓存同时被查询线程和后台写入线程访问；每次写入递增代数，查询期间发生写入则不缓存其结果
+        self._cache_lock = threading.Lock()
+        self._write_generation = 0
+        self._closed = False
+        # 写入由后台线程完成，使下一批文件的提取与嵌入和本批写入重叠
+        self._write_q: "queue.Queue[tuple]" = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._writer_loop, name="kb-writer", daemon=True)
+        self._writer.start()
+        # 调用方未 flush/close 时，解释器退出前仍把队列中的批次写完
+        atexit.register(self.close)
     
-    def add_documents(self, documents: List[Dict[str, Any]]):
-        """添加文档到向量数据库"""
-        if not documents:
+    def _writer_loop(self):
+        """后台写入线程：依次取出 (texts, ids, metadatas, embeddings) 批次写入向量数据库"""
+        # SQLite 连接按线程复用，需要在写入线程上调整参数
+        self._tune_sqlite()
+        while True:
+            item = self._write_q.get()
+            if item is None:
+                self._write_q.task_done()
+                break
+            texts, ids, metadatas, embeddings = item
+            try:
+                self.collection.add(
+                    documents=texts,
+                    ids=ids,
+                    metadatas=metadatas,
+                    embeddings=embeddings
+                )
+                logger.info(f"成功添加 {len(texts)} 个文档块到向量数据库")
+            except Exception as e:
+                logger.error(f"添加文档到向量数据库时出错: {e}")
+            finally:
+                # 写入失败也可能已部分落盘，同样使缓存失效
+                self._invalidate_cache()
+                self._write_q.task_done()
+    
+    def flush(self):
+        """等待后台写入队列中的所有批次写入完成"""
+        self._write_q.join()
+    
+    def close(self):
+        """写完队列中剩余的批次并停止后台写入线程"""
+        if self._closed:
+            return
+        self._closed = True
+        self._write_q.put(None)
+        self._writer.join()
+        atexit.unregister(self.close)
+    
+    def _tune_sqlite(self):
+        """为批量写入调整 ChromaDB 底层 SQLite 连接（WAL 日志 + NORMAL 同步）"""
+        try:
+            from chromadb.db.impl.sqlite import SqliteDB
+            # SQLite 连接按线程复用，synchronous 等设置只作用于当前线程的连接
+            conn = self.chroma_client._system.instance(SqliteDB)._conn_pool.connect()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+        except Exception as e:
+            logger.warning(f"调整SQLite参数失败，使用默认设置: {e}")
+    
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """直接调用嵌入模型批量计算归一化向量，避免 collection.add 内部逐次调用嵌入函数"""
+        return np.ascontiguousarray(self.embedding.encode(texts), dtype=np.float32)
+    
+    def add_documents(self, texts: List[str], ids: List[str], metadatas: List[Dict[str, Any]]):
+        """将文档块加入后台写入队列（需要立即可查时调用 flush）"""
+        if not texts:
+            return
+        if self._closed:
+            logger.error("知识库已关闭，无法添加文档")
             return
-        
-        texts = [doc['text'] for doc in documents]
-        ids = [doc['id'] for doc in documents]
-        metadatas = [doc['metadata'] for doc in documents]
         
         try:
-            self.collection.add(
-                documents=texts,
-                ids=ids,
-                metadatas=metadatas
-            )
-            logger.info(f"成功添加 {len(documents)} 个文档块到向量数据库")
+            embeddings = self.embed_texts(texts)
         except Exception as e:
-            logger.error(f"添加文档到向量数据库时出错: {e}")
+            logger.error(f"计算文档嵌入向量时出错: {e}")
+            return
+        # chromadb 0.4 只接受 list 形式的 embeddings，在交给写入线程前转换
+        self._write_q.put((texts, ids, metadatas, embeddings.tolist()))
+    
+    def is_file_indexed(self, file_path: str, stat: Optional[os.stat_result] = None) -> bool:
+        """检查文件当前版本是否已入库"""
+        try:
+            file_id = self.generate_file_id(file_path, stat)
+            return bool(self.collection.get(where={"file_id": file_id}, limit=1, include=[])['ids'])
+        except Exception as e:
+            logger.error(f"检查文件 {file_path} 索引状态时出错: {e}")
+            return False
+    
+    def remove_stale_chunks(self, file_path: str, file_id: str):
+        """新版本写入成功后，删除同一路径下旧版本文件的文档块"""
+        try:
+            # 新版本没有写入成功时保留旧文档块，避免文件从索引中消失
+            if not self.collection.get(where={"file_id": file_id}, limit=1, include=[])['ids']:
+                return
+            # 按 ID 前缀判断旧版本：早期写入的文档块没有 file_id 元数据，$ne 过滤匹配不到它们
+            new_prefix = f"{file_id}_chunk_"
+            stale_ids = [
+                chunk_id for chunk_id in self.collection.get(where={"file_path": file_path}, include=[])['ids']
+                if not chunk_id.startswith(new_prefix)
+            ]
+            if stale_ids:
+                self.collection.delete(ids=stale_ids)
+                self._invalidate_cache()
+        except Exception as e:
+            logger.error(f"删除文件 {file_path} 的旧文档块时出错: {e}")
     
     def process_directory(self, directory_path: str):
         """处理目录中的所有支持的文件"""
         supported_extensions = {'.txt', '.pdf', '.docx', '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif'}
         
+        # 先按扩展名过滤再取 stat，每个文件只 stat 一次并传给后续的ID生成与元数据提取
+        file_stats = []
+        for entry in _iter_files(directory_path):
+            if os.path.splitext(entry.name)[1].lower() not in supported_extensions:
+                continue
+            try:
+                stat = entry.stat()
+            except OSError as e:
+                logger.error(f"读取文件信息失败 {entry.path}: {e}")
+                continue
+            if self.is_file_indexed(entry.path, stat):
+                logger.info(f"文件未变化，跳过: {entry.path}")
+                continue
+            file_stats.append((entry.path, stat))
+        
         processed_files = 0
         total_chunks = 0
+        # 跨文件累积文档块，凑满一批再写入，让嵌入模型一次处理大批量文本
+        pending_texts, pending_ids, pending_metadatas = [], [], []
+        # 本次重新入库的文件：file_path -> 新的 file_id，全部写入后再清理旧版本
+        new_file_ids = {}
+        
+        def collect(batch: DocumentBatch):
+            nonlocal pending_texts, pending_ids, pending_metadatas, processed_files, total_chunks
+            texts, ids, metadatas = batch
+            if texts:
+                new_file_ids[metadatas[0]['file_path']] = metadatas[0]['file_id']
+                pending_texts.extend(texts)
+                pending_ids.extend(ids)
+                pending_metadatas.extend(metadatas)
+                processed_files += 1
+                total_chunks += len(texts)
+            # 数据库写入只在主进程进行，避免 SQLite 写冲突
+            while len(pending_texts) >= BATCH_SIZE:
+                self.add_documents(pending_texts[:BATCH_SIZE], pending_ids[:BATCH_SIZE],
+                                   pending_metadatas[:BATCH_SIZE])
+                pending_texts = pending_texts[BATCH_SIZE:]
+                pending_ids = pending_ids[BATCH_SIZE:]
+                pending_metadatas = pending_metadatas[BATCH_SIZE:]
         
-        for root, dirs, files in os.walk(directory_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_ext = os.path.splitext(file)[1].lower()
-                
-                if file_ext in supported_extensions:
+        if EXTRACT_WORKERS <= 1 or len(file_stats) <= 1:
+            for file_path, stat in file_stats:
+                logger.info(f"处理文件: {file_path}")
+                collect(self.process_file(file_path, stat))
+        else:
+            with ProcessPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+                futures = {executor.submit(_process_file_worker, path, stat): path for path, stat in file_stats}
+                for future in as_completed(futures):
+                    file_path = futures[future]
                     logger.info(f"处理文件: {file_path}")
-                    documents = self.process_file(file_path)
-                    if documents:
-                        self.add_documents(documents)
-                        processed_files += 1
-                        total_chunks += len(documents)
+                    try:
+                        batch = future.result()
+                    except Exception as e:
+                        logger.error(f"处理文件 {file_path} 时出错: {e}")
+                        continue
+                    collect(batch)
         
+        self.add_documents(pending_texts, pending_ids, pending_metadatas)
+        self.flush()
+        for file_path, file_id in new_file_ids.items():
+            self.remove_stale_chunks(file_path, file_id)
         logger.info(f"处理完成: {processed_files} 个文件，{total_chunks} 个文档块")
     
+    def _format_results(self, results: Dict[str, Any], index: int) -> List[Dict[str, Any]]:
+        """将 collection.query 返回的第 index 个查询结果格式化"""
+        formatted_results = []
+        for i in range(len(results['documents'][index])):
+            formatted_results.append({
+                'text': results['documents'][index][i],
+                'metadata': results['metadatas'][index][i],
+                'distance': results['distances'][index][i] if 'distances' in results else None
+            })
+        return formatted_results
+    
+    def _invalidate_cache(self):
+        """数据库内容变化时清空搜索缓存并递增写入代数"""
+        with self._cache_lock:
+            self._write_generation += 1
+            self._search_cache.clear()
+    
+    def _cached_results(self, key: tuple) -> Optional[List[Dict[str, Any]]]:
+        """读取搜索结果缓存，命中时返回副本，未命中返回 None"""
+        with self._cache_lock:
+            if key not in self._search_cache:
+                return None
+            self._search_cache.move_to_end(key)
+            return copy.deepcopy(self._search_cache[key])
+    
+    def _cache_results(self, key: tuple, formatted_results: List[Dict[str, Any]], generation: int):
+        """写入搜索结果缓存，超出容量时淘汰最久未使用的条目；查询开始后有过写入则不缓存"""
+        with self._cache_lock:
+            if generation != self._write_generation:
+                return
+            self._search_cache[key] = formatted_results
+            if len(self._search_cache) > SEARCH_CACHE_SIZE:
+                self._search_cache.popitem(last=False)
+    
     def search(self, query: str, n_results: int = 5) -> List[Dict[str, Any]]:
-        """搜索向量数据库"""
+        """搜索向量数据库（相同查询命中 LRU 缓存时直接返回）"""
+        key = (query, n_results)
+        cached = self._cached_results(key)
+        if cached is not None:
+            return cached
+        
+        generation = self._write_generation
         try:
             results = self.collection.query(
                 query_texts=[query],
@@ -250,19 +698,46 @@ class AdvancedVectorKnowledgeBase:
             )
             
             # 格式化结果
-            formatted_results = []
-            for i in range(len(results['documents'][0])):
-                formatted_results.append({
-                    'text': results['documents'][0][i],
-                    'metadata': results['metadatas'][0][i],
-                    'distance': results['distances'][0][i] if 'distances' in results else None
-                })
-            
-            return formatted_results
+            formatted_results = self._format_results(results, 0)
+            self._cache_results(key, formatted_results, generation)
+            return copy.deepcopy(formatted_results)
         except Exception as e:
             logger.error(f"搜索时出错: {e}")
             return []
     
+    def search_many(self, queries: List[str], n_results: int = 5) -> List[List[Dict[str, Any]]]:
+        """批量搜索：未命中缓存的查询合并为一次 collection.query 调用，按输入顺序返回结果"""
+        found = {}
+        missing = []
+        for query in dict.fromkeys(queries):
+            cached = self._cached_results((query, n_results))
+            if cached is None:
+                missing.append(query)
+            else:
+                found[query] = cached
+        
+        if missing:
+            generation = self._write_generation
+            try:
+                results = self.collection.query(
+                    query_texts=missing,
+                    n_results=n_results
+                )
+                for i, query in enumerate(missing):
+                    found[query] = self._format_results(results, i)
+                    self._cache_results((query, n_results), found[query], generation)
+            except Exception as e:
+                logger.error(f"批量搜索时出错: {e}")
+        
+        return [copy.deepcopy(found.get(query, [])) for query in queries]
+    
+    def distance_to_similarity(self, distance: float) -> float:
+        """按集合的距离度量把搜索距离换算为相似度（归一化向量下即余弦相似度）"""
+        if self._distance_space == "l2":
+            # 归一化向量的平方欧氏距离 = 2 - 2cos
+            return 1 - distance / 2
+        return 1 - distance
+    
     def get_collection_info(self) -> Dict[str, Any]:
         """获取集合信息"""
         try:
@@ -278,9 +753,22 @@ class AdvancedVectorKnowledgeBase:
     def export_search_results(self, query: str, n_results: int = 10, output_file: str = "search_results.json"):
         """导出搜索结果到JSON文件"""
         results = self.search(query, n_results)
+        self.export_results_direct(results, output_file)
+    
+    def export_results_direct(self, results: List[Dict[str, Any]], output_file: str = "search_results.json"):
+        """将已有的搜索结果直接导出到JSON文件，无需重新搜索"""
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(results, f, ensure_ascii=False, indent=2, default=str)
+            try:
+                import orjson
+                with open(output_file, 'wb') as f:
+                    f.write(orjson.dumps(
+                        results,
+                        option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY,
+                        default=str
+                    ))
+            except ImportError:
+                with open(output_file, 'w', encoding='utf-8') as f:
+                    json.dump(results, f, ensure_ascii=False, indent=2, default=str)
             logger.info(f"搜索结果已导出到: {output_file}")
         except Exception as e:
             logger.error(f"导出搜索结果失败: {e}")
@@ -347,22 +835,22 @@ def main():
     print("\n5. 演示搜索功能:")
     queries = ["汽车零部件", "豆包MarsCode", "停机时间", "编程助手"]
     
-    for query in queries:
+    for query, results in zip(queries, kb.search_many(queries, n_results=3)):
         print(f"\n搜索查询: '{query}'")
-        results = kb.search(query, n_results=3)
         
         for i, result in enumerate(results, 1):
             print(f"  结果 {i}:")
             print(f"    文件: {result['metadata']['file_name']}")
             print(f"    类型: {result['metadata']['file_type']}")
             print(f"    文本片段: {result['text'][:150]}...")
-            if result['distance']:
-                print(f"    相似度: {1 - result['distance']:.3f}")
+            if result['distance'] is not None:
+                print(f"    相似度: {kb.distance_to_similarity(result['distance']):.3f}")
     
     # 导出搜索结果
     print("\n6. 导出搜索结果...")
     kb.export_search_results("汽车零部件", 5, "汽车零部件搜索结果.json")
     
+    kb.close()
     print("\n=== 向量知识库系统运行完成 ===")
 
 if __name__ == "__main__":
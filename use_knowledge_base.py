@@ -54,14 +54,14 @@ def search_knowledge_base(kb):
             print(f"\n📄 结果 {i}:")
             print(f"   文件: {result['metadata']['file_name']}")
             print(f"   类型: {result['metadata']['file_type']}")
-            print(f"   相似度: {1 - result['distance']:.3f}" if result['distance'] else "   相似度: N/A")
+            print(f"   相似度: {kb.distance_to_similarity(result['distance']):.3f}" if result['distance'] is not None else "   相似度: N/A")
             print(f"   内容: {result['text'][:200]}...")
             
         # 询问是否导出结果
         export = input("\n是否导出搜索结果到文件? (y/n): ").lower()
         if export == 'y':
             filename = input("请输入文件名 (默认: search_results.json): ").strip() or "search_results.json"
-            kb.export_search_results(query, n_results, filename)
+            kb.export_results_direct(results, filename)
             print(f"✅ 搜索结果已导出到: {filename}")
 
 def show_statistics(kb):
@@ -130,6 +130,7 @@ def main():
         elif choice == '3':
             export_results(kb)
         elif choice == '4':
+            kb.close()
             print("\n👋 感谢使用向量知识库系统!")
             break
         else: